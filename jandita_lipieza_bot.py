@@ -1,13 +1,25 @@
 import os
+import array
+import asyncio
+import bisect
 import datetime
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import functools
+import itertools
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
 )
 
+logger = logging.getLogger(__name__)
+
 # ----------------------------
 # Config (env vars on Railway)
 # ----------------------------
@@ -17,7 +29,12 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not TOKEN:
     raise RuntimeError("Set env var TOKEN with your bot token")
 if not DATABASE_URL:
-    raise RuntimeError("Set env var DATABASE_URL with your Postgres connection string")
+    raise RuntimeError("Set env var DATABASE_URL with your Postgres connection string (or sqlite:///path.db)")
+
+# Single-instance deployments can keep the schedule in a local SQLite file instead:
+# sqlite:///schedule.db (relative) or sqlite:////data/schedule.db (absolute)
+USE_SQLITE = DATABASE_URL.startswith("sqlite://")
+SQLITE_PATH = (DATABASE_URL.removeprefix("sqlite://").removeprefix("/") or "schedule.db") if USE_SQLITE else None
 
 # Manual Spanish month abbreviations (capitalized)
 MONTHS_SHORT = {
@@ -26,29 +43,91 @@ MONTHS_SHORT = {
     9: "Sep", 10: "Oct", 11: "Nov", 12: "Dic"
 }
 
-# In-memory cache of current planning window (overlayed from DB on start or /plan)
-weeks = {}  # {start_iso: {"start": date, "end": date, "familia": str|None, "turno": str|None}}
-pending_edits = {}  # {user_id: {"week": key, "field": "familia"|"turno"}}
+# Static keyboard rows (buttons are immutable, so they can be shared across markups)
+HEADER_ROW = [
+    InlineKeyboardButton("📅 Semana", callback_data="noop"),
+    InlineKeyboardButton("👨‍👩‍👧 Familia", callback_data="noop"),
+    InlineKeyboardButton("⏰ Turno", callback_data="noop"),
+]
+SHOW_ALL_ROW = [InlineKeyboardButton("📅 Mostrar todo", callback_data="show_all")]
+SHOW_3M_ROW = [InlineKeyboardButton("◀ Volver a 3 meses", callback_data="show_3m")]
+
+# Same body for both views: the toggle row already says which one is shown,
+# so switching views only has to replace the keyboard
+PLAN_TEXT = "📅 Planificación:"
+
+# In-memory planning window, loaded from DB at startup and extended by /plan.
+# Stored as parallel lists indexed by week position; key_to_idx maps start_iso -> index.
+week_keys: list[str] = []
+week_start_ord = array.array("i")  # date.toordinal() of each Monday; weeks end 6 days later
+week_familia: list[str | None] = []
+week_turno: list[str | None] = []
+# Derived once per week (dates never change): display label and callback_data strings
+week_labels: list[str] = []
+cb_week: list[str] = []
+cb_familia: list[str] = []
+cb_turno: list[str] = []
+key_to_idx: dict[str, int] = {}
+WEEK_COLUMNS = (
+    week_keys, week_start_ord, week_familia, week_turno,
+    week_labels, cb_week, cb_familia, cb_turno,
+)
+# Pending edits live in context.user_data["pending_edit"] = {"week": key, "field": "familia"|"turno"}
+
+# Rendered keyboards, keyed by (show_all, today ordinal, _kb_version).
+# Bump _kb_version whenever the week lists change so stale markups are never served.
+_kb_cache: dict[tuple, InlineKeyboardMarkup] = {}
+_kb_version = 0
+
+# Composed "week" info replies, keyed by start_iso; entries are dropped when that week changes
+_info_msg_cache: dict[str, str] = {}
 
 # ----------------------------
 # Database helpers
 # ----------------------------
+_pool = None
+
+@contextmanager
 def get_conn():
-    # One global connection; Railway keeps a stable network for the container
-    # Reconnect if needed
-    global _conn
+    # Small shared pool so concurrent handlers don't serialize on one connection.
+    # Created lazily; connections are returned to the pool on exit, and broken
+    # ones are discarded so the next borrow reconnects.
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(minconn=1, maxconn=4, dsn=DATABASE_URL)
+    conn = _pool.getconn()
     try:
-        if _conn and _conn.closed == 0:
-            return _conn
-    except NameError:
-        pass
-    _conn = psycopg2.connect(DATABASE_URL)
-    _conn.autocommit = True
-    return _conn
+        conn.autocommit = True
+        yield conn
+    finally:
+        _pool.putconn(conn, close=bool(conn.closed))
+
+_sqlite_conn = None
+_sqlite_lock = threading.Lock()
+
+@contextmanager
+def get_cursor():
+    """Yield a cursor on the configured backend (Postgres pool or local SQLite file)."""
+    if not USE_SQLITE:
+        with get_conn() as conn, conn.cursor() as cur:
+            yield cur
+        return
+
+    # One in-process connection, shared by the event loop and the db-writer thread
+    global _sqlite_conn
+    with _sqlite_lock:
+        if _sqlite_conn is None:
+            _sqlite_conn = sqlite3.connect(SQLITE_PATH, isolation_level=None, check_same_thread=False)
+            _sqlite_conn.execute("PRAGMA journal_mode=WAL;")
+            _sqlite_conn.execute("PRAGMA synchronous=NORMAL;")
+        cur = _sqlite_conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
 
 def init_db():
-    conn = get_conn()
-    with conn.cursor() as cur:
+    with get_cursor() as cur:
         cur.execute("""
         CREATE TABLE IF NOT EXISTS schedule (
             week_start DATE PRIMARY KEY,
@@ -56,158 +135,256 @@ def init_db():
             turno   TEXT
         );
         """)
-    return conn
+        # Lets the windowed load in load_weeks_from_db run as an index-only scan
+        if USE_SQLITE:
+            # SQLite has no INCLUDE; a composite index covers the same columns
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS schedule_window
+                ON schedule (week_start, familia, turno);
+            """)
+        else:
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS schedule_window
+                ON schedule (week_start) INCLUDE (familia, turno);
+            """)
 
 def upsert_week(week_start: datetime.date, familia, turno):
-    conn = get_conn()
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO schedule (week_start, familia, turno)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (week_start)
-            DO UPDATE SET familia = EXCLUDED.familia, turno = EXCLUDED.turno;
-        """, (week_start, familia, turno))
-
-def load_all_weeks_from_db():
-    conn = get_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT week_start, familia, turno FROM schedule;")
+    upsert_weeks_bulk([(week_start, familia, turno)])
+
+def upsert_weeks_bulk(rows: list[tuple[datetime.date, str | None, str | None]]):
+    """Upsert many (week_start, familia, turno) rows in a single round-trip."""
+    if not rows:
+        return
+    with get_cursor() as cur:
+        if USE_SQLITE:
+            # Dates are stored as ISO strings (same format Postgres returns for DATE)
+            cur.executemany("""
+                INSERT INTO schedule (week_start, familia, turno)
+                VALUES (?, ?, ?)
+                ON CONFLICT (week_start)
+                DO UPDATE SET familia = EXCLUDED.familia, turno = EXCLUDED.turno;
+            """, [(wk.isoformat(), familia, turno) for wk, familia, turno in rows])
+        else:
+            execute_values(cur, """
+                INSERT INTO schedule (week_start, familia, turno)
+                VALUES %s
+                ON CONFLICT (week_start)
+                DO UPDATE SET familia = EXCLUDED.familia, turno = EXCLUDED.turno;
+            """, rows)
+
+# Single worker so background writes reach the DB in the order edits were made
+_db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+def _log_write_failure(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.error("Failed to persist week", exc_info=fut.exception())
+
+def upsert_week_in_background(week_start: datetime.date, familia, turno):
+    """Schedule upsert_week off the event loop; failures are logged, not raised."""
+    loop = asyncio.get_running_loop()
+    fut = loop.run_in_executor(_db_writer, upsert_week, week_start, familia, turno)
+    fut.add_done_callback(_log_write_failure)
+
+def load_weeks_from_db(first_start: datetime.date, last_start: datetime.date):
+    """Return (week_start, familia, turno) tuples for weeks starting in [first_start, last_start]."""
+    with get_cursor() as cur:
+        if USE_SQLITE:
+            cur.execute(
+                "SELECT week_start, familia, turno FROM schedule"
+                " WHERE week_start BETWEEN ? AND ? ORDER BY week_start;",
+                (first_start.isoformat(), last_start.isoformat()),
+            )
+            return [(datetime.date.fromisoformat(wk), familia, turno) for wk, familia, turno in cur]
+        cur.execute(
+            "SELECT week_start, familia, turno FROM schedule"
+            " WHERE week_start BETWEEN %s AND %s ORDER BY week_start;",
+            (first_start, last_start),
+        )
         return cur.fetchall()
 
 # ----------------------------
 # Planning helpers
 # ----------------------------
-def format_short_date(d: datetime.date) -> str:
+def invalidate_keyboards():
+    global _kb_version
+    _kb_version += 1
+    _kb_cache.clear()
+
+@functools.lru_cache(maxsize=1024)
+def format_short_date(ordinal: int) -> str:
+    d = datetime.date.fromordinal(ordinal)
     return f"{d.day} {MONTHS_SHORT[d.month]}"
 
-def generate_weeks():
-    """Create in-memory weeks from current week to end of June (this year or next). Then overlay DB values."""
-    today = datetime.date.today()
-    end = datetime.date(today.year, 6, 30) if today.month <= 6 else datetime.date(today.year + 1, 6, 30)
-
-    weeks.clear()
-    start = today - datetime.timedelta(days=today.weekday())  # Monday of current week
-    while start <= end:
-        end_week = start + datetime.timedelta(days=6)
-        key = start.isoformat()
-        weeks[key] = {"start": start, "end": end_week, "familia": None, "turno": None}
-        start += datetime.timedelta(weeks=1)
-
-    # Overlay with DB data (only for weeks in our window)
-    for row in load_all_weeks_from_db():
-        wk = row["week_start"]
-        key = wk.isoformat()
-        if key in weeks:
-            weeks[key]["familia"] = row["familia"]
-            weeks[key]["turno"] = row["turno"]
+@functools.lru_cache(maxsize=1)
+def _season_end(today_ord: int) -> int:
+    """Ordinal of the 30 June that closes the planning season containing today_ord."""
+    today = datetime.date.fromordinal(today_ord)
+    return datetime.date(today.year + (0 if today.month <= 6 else 1), 6, 30).toordinal()
 
-def build_week_table(show_all: bool = False) -> InlineKeyboardMarkup:
-    rows = []
-
-    # Header row (labels only)
-    rows.append([
-        InlineKeyboardButton("📅 Semana", callback_data="noop"),
-        InlineKeyboardButton("👨‍👩‍👧 Familia", callback_data="noop"),
-        InlineKeyboardButton("⏰ Turno", callback_data="noop"),
-    ])
+def generate_weeks():
+    """Keep in-memory weeks spanning current week to end of June (this year or next).
 
+    The in-memory values are authoritative once loaded, so this only drops weeks that
+    have passed and appends new ones, overlaying DB values for the appended range only.
+    """
     today = datetime.date.today()
-    cutoff = today + datetime.timedelta(weeks=12)  # ~3 months
+    first = today.toordinal() - today.weekday()  # Monday of current week
+    last = _season_end(today.toordinal())
+
+    # Drop weeks that have already passed
+    passed = bisect.bisect_left(week_start_ord, first)
+    if passed:
+        for key in week_keys[:passed]:
+            _info_msg_cache.pop(key, None)
+        for lst in WEEK_COLUMNS:
+            del lst[:passed]
+        key_to_idx.clear()
+        key_to_idx.update((key, i) for i, key in enumerate(week_keys))
+
+    # Append weeks not generated yet
+    start = week_start_ord[-1] + 7 if week_start_ord else first
+    new_from = len(week_start_ord)
+    while start <= last:
+        key = datetime.date.fromordinal(start).isoformat()
+        key_to_idx[key] = len(week_keys)
+        week_keys.append(key)
+        week_start_ord.append(start)
+        week_familia.append(None)
+        week_turno.append(None)
+        week_labels.append(f"{format_short_date(start)} – {format_short_date(start + 6)}")
+        cb_week.append("week:" + key)
+        cb_familia.append("familia:" + key)
+        cb_turno.append("turno:" + key)
+        start += 7
+
+    # Overlay with DB data (only for the newly added weeks)
+    if len(week_start_ord) > new_from:
+        first_start = datetime.date.fromordinal(week_start_ord[new_from])
+        last_start = datetime.date.fromordinal(week_start_ord[-1])
+        for wk, familia, turno in load_weeks_from_db(first_start, last_start):
+            i = key_to_idx.get(wk.isoformat())
+            if i is not None:
+                week_familia[i] = familia
+                week_turno[i] = turno
+
+    if passed or len(week_start_ord) > new_from:
+        invalidate_keyboards()
 
-    for key in sorted(weeks.keys()):
-        w = weeks[key]
-        if not show_all and w["start"] > cutoff:
-            continue
-
-        semana = f"{format_short_date(w['start'])} – {format_short_date(w['end'])}"
-        familia = w["familia"] if w["familia"] else "—"
-        turno = w["turno"] if w["turno"] else "—"
-
-        rows.append([
-            InlineKeyboardButton(semana, callback_data=f"week:{key}"),
-            InlineKeyboardButton(familia, callback_data=f"familia:{key}"),
-            InlineKeyboardButton(turno, callback_data=f"turno:{key}"),
-        ])
-
-    if not show_all:
-        rows.append([InlineKeyboardButton("📅 Mostrar todo", callback_data="show_all")])
+def build_week_table(show_all: bool = False) -> InlineKeyboardMarkup:
+    today_ord = datetime.date.today().toordinal()
+    cache_key = (show_all, today_ord, _kb_version)
+    kb = _kb_cache.get(cache_key)
+    if kb is not None:
+        return kb
+
+    # generate_weeks appends weeks in chronological order, so the 3-month view is a prefix
+    if show_all:
+        n = len(week_start_ord)
     else:
-        rows.append([InlineKeyboardButton("◀ Volver a 3 meses", callback_data="show_3m")])
+        n = bisect.bisect_right(week_start_ord, today_ord + 12 * 7)  # ~3 months
+
+    rows = [HEADER_ROW]
+    rows.extend([
+        [
+            InlineKeyboardButton(label, callback_data=cb_w),
+            InlineKeyboardButton(familia or "—", callback_data=cb_f),
+            InlineKeyboardButton(turno or "—", callback_data=cb_t),
+        ]
+        for label, familia, turno, cb_w, cb_f, cb_t in itertools.islice(
+            zip(week_labels, week_familia, week_turno, cb_week, cb_familia, cb_turno), n
+        )
+    ])
+    rows.append(SHOW_3M_ROW if show_all else SHOW_ALL_ROW)
 
-    return InlineKeyboardMarkup(rows)
+    kb = InlineKeyboardMarkup(rows)
+    _kb_cache[cache_key] = kb
+    return kb
 
 # ----------------------------
 # Handlers
 # ----------------------------
 async def cmd_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    init_db()
     generate_weeks()
     kb = build_week_table(show_all=False)
-    await update.message.reply_text("📅 Planificación (próximos 3 meses):", reply_markup=kb)
+    await update.message.reply_text(PLAN_TEXT, reply_markup=kb)
+
+async def _on_edit_field(query, context: ContextTypes.DEFAULT_TYPE, field: str, key: str):
+    i = key_to_idx[key]
+    context.user_data["pending_edit"] = {"week": key, "field": field}
+    await query.message.reply_text(
+        f"Escribe el {field} para la semana "
+        f"{week_labels[i]} "
+        f"(o /remove para borrar)."
+    )
+
+async def _on_week(query, context: ContextTypes.DEFAULT_TYPE, field: str, key: str):
+    msg = _info_msg_cache.get(key)
+    if msg is None:
+        i = key_to_idx[key]
+        msg = (
+            f"📅 {week_labels[i]}\n"
+            f"Familia: {week_familia[i] or '—'}\n"
+            f"Turno: {week_turno[i] or '—'}"
+        )
+        _info_msg_cache[key] = msg
+    await query.message.reply_text(msg)
+
+async def _on_show_all(query, context: ContextTypes.DEFAULT_TYPE, field: str, key: str):
+    await query.edit_message_reply_markup(reply_markup=build_week_table(show_all=True))
+
+async def _on_show_3m(query, context: ContextTypes.DEFAULT_TYPE, field: str, key: str):
+    await query.edit_message_reply_markup(reply_markup=build_week_table(show_all=False))
+
+# callback_data prefix -> handler; anything else (e.g. header "noop") is ignored
+DISPATCH = {
+    "familia": _on_edit_field,
+    "turno": _on_edit_field,
+    "week": _on_week,
+    "show_all": _on_show_all,
+    "show_3m": _on_show_3m,
+}
 
 async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    data = query.data.split(":", 1)
-    field = data[0]
-
-    if field in ("familia", "turno"):
-        key = data[1]
-        pending_edits[query.from_user.id] = {"week": key, "field": field}
-        await query.message.reply_text(
-            f"Escribe el {field} para la semana "
-            f"{format_short_date(weeks[key]['start'])} – {format_short_date(weeks[key]['end'])} "
-            f"(o /remove para borrar)."
-        )
-
-    elif field == "week":
-        key = data[1]
-        w = weeks[key]
-        await query.message.reply_text(
-            f"📅 {format_short_date(w['start'])} – {format_short_date(w['end'])}\n"
-            f"Familia: {w['familia'] or '—'}\n"
-            f"Turno: {w['turno'] or '—'}"
-        )
-
-    elif field == "show_all":
-        kb = build_week_table(show_all=True)
-        await query.edit_message_text("📅 Planificación completa (hasta junio):", reply_markup=kb)
-
-    elif field == "show_3m":
-        kb = build_week_table(show_all=False)
-        await query.edit_message_text("📅 Planificación (próximos 3 meses):", reply_markup=kb)
+    field, _, key = query.data.partition(":")
+    handler = DISPATCH.get(field)
+    if handler:
+        await handler(query, context, field, key)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    if user_id not in pending_edits:
+    edit = context.user_data.pop("pending_edit", None)
+    if edit is None:
         return
 
-    edit = pending_edits.pop(user_id)
     week_key = edit["week"]
-    field = edit["field"]
+    column = week_familia if edit["field"] == "familia" else week_turno
+    i = key_to_idx[week_key]
 
     # Update in memory
-    if update.message.text.strip().lower() == "/remove":
-        weeks[week_key][field] = None
-    else:
-        weeks[week_key][field] = update.message.text.strip()
+    text = update.message.text.strip()
+    column[i] = None if text.lower() == "/remove" else text
+    invalidate_keyboards()
+    _info_msg_cache.pop(week_key, None)
 
-    # Persist to DB (upsert both fields for that week_start)
-    week_start_date = datetime.date.fromisoformat(week_key)
-    familia = weeks[week_key]["familia"]
-    turno = weeks[week_key]["turno"]
-    upsert_week(week_start_date, familia, turno)
+    # Persist to DB (upsert both fields for that week_start) without blocking the reply
+    week_start_date = datetime.date.fromordinal(week_start_ord[i])
+    upsert_week_in_background(week_start_date, week_familia[i], week_turno[i])
 
     # Refresh 3-month view
     kb = build_week_table(show_all=False)
     await update.message.reply_text("✅ Planificación actualizada:", reply_markup=kb)
 
+    # Warm the full view too, so the next "Mostrar todo" is served from _kb_cache
+    build_week_table(show_all=True)
+
 # ----------------------------
 # Main
 # ----------------------------
 def main():
     init_db()
+    generate_weeks()
     app = Application.builder().token(TOKEN).build()
     app.add_handler(CommandHandler("plan", cmd_plan))
     app.add_handler(CallbackQueryHandler(handle_button))